@@ -2,7 +2,7 @@
 # After data is scraped it is saved to output folder as a parquet file of specified format
 # Data is saved in the separate folder every month. If data for the current month is downloaded
 # then previously downloaded data is deleted.
-# The scrapper uses multiprocessing, e.g. loads several urls simultaneously
+# The scrapper uses a thread pool, e.g. loads several urls simultaneously
 # Note that result might contain duplicate rows!!!
 # 
 # 2025-04-03
@@ -11,18 +11,27 @@
 import os
 import re
 import logging
-import json
+import threading
+from dataclasses import fields
+from functools import lru_cache
 from itertools import product
 from datetime import datetime
-from typing import List
+from typing import Any, Dict, Iterator, List, Tuple
 from time import sleep
 from uuid import uuid4
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+import orjson
 import requests
 from requests import HTTPError
 from pydantic import ValidationError
-import pandas as pd
-from shapely.geometry import shape, Point
+import pyarrow as pa
+import pyarrow.parquet as pq
+import h3
+import numpy as np
+import shapely
+from shapely.geometry import shape
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
 
 import settings
 from models import URLModel, AdvertModel
@@ -35,21 +44,134 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger('main')
+_thread_local = threading.local()
+# Limits the number of simultaneous requests to the host across all worker threads
+_connections = threading.BoundedSemaphore(settings.MAX_CONNECTIONS)
+# Matches floor and total floors in advert title, e.g. "5/9 этаж"
+FLOOR_RE = re.compile(r'(\d+)/(\d+)')
+# Advert fields read from API response, the rest of the payload is dropped before validation
+ADVERT_FIELDS = tuple(field.name for field in fields(AdvertModel))
+
+
+"""
+Schema of the output parquet files. Column `extract_datetime` is added to each chunk on save
+Small numbers and coordinates use narrow types, price stays float64 to keep large sale prices exact
+"""
+RECORD_SCHEMA = pa.schema([
+    ('id', pa.int64()),
+    ('city', pa.string()),
+    ('district', pa.string()),
+    ('address', pa.string()),
+    ('title', pa.string()),
+    ('property', pa.string()),
+    ('deal_type', pa.string()),
+    ('duration', pa.string()),
+    ('rooms', pa.int16()),
+    ('square', pa.float32()),
+    ('price', pa.float64()),
+    ('number_of_photos', pa.int16()),
+    ('seller', pa.string()),
+    ('latitude', pa.float32()),
+    ('longitude', pa.float32()),
+    ('floor', pa.int16()),
+    ('total_floors', pa.int16()),
+    ('url', pa.string()),
+    ('bounds', pa.string()),
+])
+EXTRACT_DATETIME_FIELD = pa.field('extract_datetime', pa.timestamp('us'))
+SCHEMA = RECORD_SCHEMA.append(EXTRACT_DATETIME_FIELD)
 
 
 """
 Functions that are used in the process of scrapping
 """
-def get_district(lat, lon) -> str:
-    with open(settings.GEOMAP_PATH, 'r', encoding='utf8') as f:
-        geo_data = json.loads(f.read())
-    point = Point(lon, lat)
+@lru_cache(maxsize=1)
+def _load_geomap() -> List[Tuple[BaseGeometry, str]]:
+    """
+    Loads district polygons from the geo map once and keeps them in memory,
+    so polygons are not rebuilt from GeoJSON for every advert
+    """
+    with open(settings.GEOMAP_PATH, 'rb') as f:
+        geo_data = orjson.loads(f.read())
+    return [
+        (shape(feature['geometry']), feature['properties'].get('id', 'Unknown district'))
+        for feature in geo_data['features']
+    ]
+
+
+@lru_cache(maxsize=1)
+def _build_strtree() -> Tuple[STRtree, List[str]]:
+    """
+    Builds a spatial index over prepared district polygons.
+    Returns the tree and district names in the same order as tree geometries
+    """
+    polygons, districts = zip(*_load_geomap())
+    polygons = np.array(polygons, dtype=object)
+    shapely.prepare(polygons)
+    return STRtree(polygons), list(districts)
+
+
+@lru_cache(maxsize=1)
+def _build_cell_index() -> Dict[str, str]:
+    """
+    Maps H3 cells that lie strictly inside a single district to that district.
+    Cells crossing a district border are left out and are resolved with polygons
+    """
+    tree, districts = _build_strtree()
+    cells = sorted({
+        cell
+        for polygon, _ in _load_geomap()
+        for cell in h3.geo_to_cells(polygon, settings.H3_RESOLUTION)
+    })
+    hexagons = shapely.polygons([
+        [(lon, lat) for lat, lon in h3.cell_to_boundary(cell)] for cell in cells
+    ])
+    # Small margin covers the difference between planar and H3 cell edges
+    hexagons = shapely.buffer(hexagons, 1e-6)
+    hexagon_idx, polygon_idx = tree.query(hexagons, predicate='intersects')
+    single = np.bincount(hexagon_idx, minlength=len(cells))[hexagon_idx] == 1
+    hexagon_idx, polygon_idx = hexagon_idx[single], polygon_idx[single]
+    inside = shapely.contains_properly(tree.geometries[polygon_idx], hexagons[hexagon_idx])
+    return {
+        cells[hexagon]: districts[polygon]
+        for hexagon, polygon in zip(hexagon_idx[inside], polygon_idx[inside])
+    }
+
+
+def _query_strtree(lats: np.ndarray, lons: np.ndarray) -> List[str]:
+    """
+    Looks up districts for a batch of points in a single tree query.
+    The tree filters polygons by bounding box first, so the exact
+    containment check is done only for a few candidates per point,
+    vectorized against prepared polygons
+    """
+    tree, districts = _build_strtree()
+    point_idx, polygon_idx = tree.query(shapely.points(lons, lats))
+    inside = shapely.contains_xy(tree.geometries[polygon_idx], lons[point_idx], lats[point_idx])
+    point_idx, polygon_idx = point_idx[inside], polygon_idx[inside]
+    # If a point matches several polygons the first one from the geo map wins
+    matches = np.full(len(lats), len(districts))
+    np.minimum.at(matches, point_idx, polygon_idx)
+    names = np.array(districts + ['District not found'], dtype=object)
+    return names[matches].tolist()
+
 
-    for feature in geo_data['features']:
-        polygon = shape(feature['geometry'])
-        if polygon.contains(point):
-            return feature['properties'].get('id', 'Unknown district')
-    return 'District not found'
+def get_districts(lats: np.ndarray, lons: np.ndarray) -> List[str]:
+    """
+    Looks up districts for a batch of points.
+    Points are resolved by their H3 cell first, points from border cells
+    or outside of the map fall back to the polygon lookup
+    """
+    cell_index = _build_cell_index()
+    result = [
+        cell_index.get(h3.latlng_to_cell(lat, lon, settings.H3_RESOLUTION))
+        for lat, lon in zip(lats.tolist(), lons.tolist())
+    ]
+    missed = [i for i, district in enumerate(result) if district is None]
+    if missed:
+        for i, district in zip(missed, _query_strtree(lats[missed], lons[missed])):
+            result[i] = district
+    return result
 
 
 def prepare_output_directory() -> None:
@@ -62,7 +184,9 @@ def prepare_output_directory() -> None:
     dirname = f'{settings.OUTPUT_FOLDER}/{datetime.now().strftime("%Y%m")}'
     if not os.path.isdir(dirname):
         os.mkdir(dirname)
-    _ = [os.remove(os.path.join(dirname, file)) for file in os.listdir(dirname)]
+    with os.scandir(dirname) as entries:
+        for entry in entries:
+            os.unlink(entry.path)
 
 
 def build_urls() -> List[URLModel]:
@@ -70,8 +194,8 @@ def build_urls() -> List[URLModel]:
     Building a list of urls from `start_urls`, `cities` and `headers` configurations
     """
     logger.info('Building URLs')
-    with open(settings.URLS_PATH, 'r', encoding='utf8') as f:
-        _urls = json.loads(f.read())
+    with open(settings.URLS_PATH, 'rb') as f:
+        _urls = orjson.loads(f.read())
         headers = _urls['headers']
         start_urls = _urls['urls']
         cities = _urls['cities']
@@ -81,60 +205,74 @@ def build_urls() -> List[URLModel]:
     ]
 
 
-def download_data(url: URLModel):
+def get_session() -> requests.Session:
+    """
+    Returns an http session bound to the current thread.
+    Worker threads reuse their session and its connections between urls
+    """
+    if not hasattr(_thread_local, 'session'):
+        _thread_local.session = requests.Session()
+    return _thread_local.session
+
+
+def download_data(url: URLModel) -> Iterator[List[AdvertModel]]:
     """
     Since the number of adverts is unknown the pager for this generatot was implemented.
     `while` loop ends once length of returned data is 0 
+    Validated adverts are yielded page by page
     """
     logger.info(f'Download {url.build_url()} started')
     url.params['page'] = 1
     
-    session = requests.Session()
+    session = get_session()
     
     while True:
         logger.debug(f"Download {url.build_url()} page number: {url.params['page']} started")
         try:
-            response = session.get(url.build_url(), headers=url.headers, params=url.params)
+            with _connections:
+                response = session.get(url.build_url(), headers=url.headers, params=url.params)
             response.raise_for_status()
         except HTTPError as e:
             logger.error(f"HTTP Error: {str(e)}")
             break
         response.raise_for_status()
-        _data = response.json()['adverts']
+        _data = orjson.loads(response.content)['adverts']
         logger.debug(f"Download {url.build_url()} page number: {url.params['page']} length of data: {len(_data)} finished")
         if len(_data) == 0:
             break
+        page = []
         for adv in _data.values():
             try:
-                yield AdvertModel(**adv, url=url.model_copy())
+                advert_fields = {field: adv[field] for field in ADVERT_FIELDS if field in adv}
+                page.append(AdvertModel(**advert_fields))
             except ValidationError as e:
-                errors = json.loads(e.json())
-                for error in errors:
+                for error in e.errors(include_url=False):
                     logger.error(f"Validation Error: {error['loc'][0]} - {error['msg']}")
-                    logger.error(f"Error Values: id {adv['id']} - {error['loc'][0]} - {adv[error['loc'][0]]}")
-            sleep(settings.SLEEP_TIME)
+                    logger.error(f"Error Values: id {adv.get('id')} - {error['loc'][0]} - {adv.get(error['loc'][0])}")
+        yield page
         url.params['page'] += 1
+        # Throttle requests to the host, not the parsing of already downloaded adverts
+        sleep(settings.SLEEP_TIME)
 
-    session.close()
     logger.info(f'Download {url.build_url()} is done')
 
 
-def transform_advert(advert: AdvertModel) -> pd.Series:
+def transform_advert(advert: AdvertModel, url: URLModel, district: str) -> Dict[str, Any]:
     """
-    Transforms each advert to a specified format
+    Transforms each advert to a specified format.
+    District is looked up beforehand for the whole chunk
     """
-    logger.debug(f"Flatten results for {advert.url.build_url()} page number: {advert.url.params['page']}")
-    floor_pattern = re.search('(\d+)/(\d+)', advert.title)
-    district =  get_district(advert.map.lat, advert.map.lon)
-    return pd.Series({
+    logger.debug(f"Flatten results for {url.build_url()} advert id: {advert.id}")
+    floor_pattern = FLOOR_RE.search(advert.title)
+    return {
         "id": advert.id,
-        "city": advert.url.city,
+        "city": url.city,
         "district": district,
         "address": advert.addressTitle,
         "title": advert.title,
-        "property": advert.url.property_type,
-        "deal_type": advert.url.deal_type,
-        "duration": advert.url.duration,
+        "property": url.property_type,
+        "deal_type": url.deal_type,
+        "duration": url.duration,
         "rooms": advert.rooms,
         "square": advert.square,
         "price": advert.price,
@@ -144,39 +282,60 @@ def transform_advert(advert: AdvertModel) -> pd.Series:
         "longitude": advert.map.lon,
         "floor": int(floor_pattern.group(1)) if floor_pattern else None,
         "total_floors": int(floor_pattern.group(2)) if floor_pattern else None,
-        "url": advert.url.build_url(),
-        "params": advert.url.params,
-        "extract_datetime": pd.to_datetime('now')
-    })
+        "url": url.build_url(),
+        "bounds": url.params.get('bounds'),
+    }
 
 
-def save_data_to_parquet(data: List[pd.Series]) -> None:
+def get_output_filename() -> str:
     """
-    Saves chunks of data into parquet file of the defined folder
+    Builds a unique name of the parquet file in the monthly output folder
     """
-    output_filename = os.path.join(
+    now = datetime.now()
+    return os.path.join(
         settings.OUTPUT_FOLDER, 
-        f"{datetime.now().strftime('%Y%m')}", 
-        f'output_{uuid4().hex}_{datetime.now().strftime("%Y%m%d%H%M%S")}.parquet'
+        f"{now.strftime('%Y%m')}", 
+        f'output_{uuid4().hex}_{now.strftime("%Y%m%d%H%M%S")}.parquet'
     ) 
-    logger.info(f'Saving output to {output_filename} rows count: {len(data)}')
-    df = pd.concat(data, axis=1).T
-    df.to_parquet(output_filename)
+
+
+def save_data_to_parquet(writer: pq.ParquetWriter, data: List[Dict[str, Any]]) -> None:
+    """
+    Appends a chunk of data to the parquet file as a separate row group
+    """
+    logger.info(f'Saving output to {writer.where} rows count: {len(data)}')
+    table = pa.Table.from_pylist(data, schema=RECORD_SCHEMA)
+    extract_datetime = pa.repeat(pa.scalar(datetime.now(), EXTRACT_DATETIME_FIELD.type), len(data))
+    writer.write_table(table.append_column(EXTRACT_DATETIME_FIELD, extract_datetime))
+
+
+def transform_chunk(adverts: List[AdvertModel], url: URLModel) -> List[Dict[str, Any]]:
+    """
+    Resolves districts for the whole chunk at once and transforms each advert
+    """
+    lats = np.fromiter((adv.map.lat for adv in adverts), dtype=float, count=len(adverts))
+    lons = np.fromiter((adv.map.lon for adv in adverts), dtype=float, count=len(adverts))
+    districts = get_districts(lats, lons)
+    return [transform_advert(adv, url, district) for adv, district in zip(adverts, districts)]
 
 
 def pipeline(url: URLModel) -> None:
+    """
+    Downloads adverts of the url and streams them in chunks into a single parquet file
+    """
     data = download_data(url)
     rows = 0
-    processed_data = []
-    for i, adv in enumerate(data, 1):
-        processed_data.append(transform_advert(adv))
-        if i % settings.CHUNK_SIZE == 0:
-            save_data_to_parquet(processed_data)
-            rows += len(processed_data)
-            processed_data.clear()
-    if processed_data:
-        save_data_to_parquet(processed_data)
-        rows += len(processed_data)
+    raw_data = []
+    with pq.ParquetWriter(get_output_filename(), SCHEMA, compression='zstd') as writer:
+        for page in data:
+            raw_data.extend(page)
+            if len(raw_data) >= settings.CHUNK_SIZE:
+                save_data_to_parquet(writer, transform_chunk(raw_data, url))
+                rows += len(raw_data)
+                raw_data.clear()
+        if raw_data:
+            save_data_to_parquet(writer, transform_chunk(raw_data, url))
+            rows += len(raw_data)
     logger.info(f'Data {url.build_url()} rows count: {rows} is saved')
 
 
@@ -184,8 +343,11 @@ def main() -> None:
     logger.info('Parsing is started')
     urls = build_urls()
     prepare_output_directory()
-    with Pool(processes=settings.PROCESSES) as p:
-        _ = p.map(pipeline, urls)
+    # Geo lookups are built before workers start, so threads share them instead of racing to build
+    logger.info('Loading geo map')
+    _build_cell_index()
+    with ThreadPoolExecutor(max_workers=settings.THREADS) as executor:
+        _ = list(executor.map(pipeline, urls))
     logger.info('Parsing is done')
 
 
@@ -1,6 +1,7 @@
 import os
 from typing import Any, Dict, List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
+from pydantic.dataclasses import dataclass
 
 
 """
@@ -15,17 +16,25 @@ class URLModel(BaseModel):
     duration: str = None
     headers: Dict[str, str]
     params: Dict[str, Any]
+    _built_url: str = PrivateAttr()
+
+    def model_post_init(self, __context: Any) -> None:
+        # The url is requested for every page and advert, so it is joined only once
+        self._built_url = os.path.join(self.url, self.url_path)
 
     def build_url(self) -> str:
-        return os.path.join(self.url, self.url_path)
+        return self._built_url
 
 
-class MapModel(BaseModel):
+# Adverts are created in thousands, so slotted dataclasses are used to keep instances small
+@dataclass(slots=True, kw_only=True)
+class MapModel:
     lat: float
     lon: float
 
 
-class AdvertModel(BaseModel):
+@dataclass(slots=True, kw_only=True)
+class AdvertModel:
     id: int
     title: str
     addressTitle: str
@@ -37,4 +46,3 @@ class AdvertModel(BaseModel):
     status: str
     storage: str
     map: MapModel
-    url: URLModel
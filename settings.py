@@ -4,7 +4,9 @@ Might be stored in a separate file and env variables if data is sensitive
 """
 SLEEP_TIME = .05
 CHUNK_SIZE = 3000
-PROCESSES = 4
+THREADS = 12
+MAX_CONNECTIONS = 8
 OUTPUT_FOLDER = 'output'
 URLS_PATH = 'urls.json'
-GEOMAP_PATH = 'almaty-geo-map.json'
\ No newline at end of file
+GEOMAP_PATH = 'almaty-geo-map.json'
+H3_RESOLUTION = 9
\ No newline at end of file